@@ -0,0 +1,140 @@
+import subprocess
+
+import pytest
+
+import vmux.__main__ as vmux
+from vmux.__main__ import Kak, Neovim, Nvr, broadcast, parse_tmux_environ
+
+
+class StubPopen(object):
+    output = b""
+
+    def __init__(self, cmd, **kwargs):
+        self.cmd = cmd
+
+    def communicate(self):
+        return self.output, b""
+
+
+@pytest.fixture
+def session_dirs(tmp_path, monkeypatch):
+    dirs = {}
+    for name, var in (
+        ("nvim", "VMUX_NVIM_SESSION_DIR"),
+        ("nvr", "VMUX_NVR_SESSION_DIR"),
+        ("kak", "VMUX_KAK_SESSION_DIR"),
+    ):
+        dirs[name] = tmp_path / name
+        monkeypatch.setenv(var, str(dirs[name]))
+    return dirs
+
+
+def test_parse_tmux_environ():
+    """Removed variables and lines without a value are skipped."""
+    assert parse_tmux_environ(b"A=1\n-B\nVMUX_SESSION_2=%3=x\n\n") == [
+        ("A", "1"),
+        ("VMUX_SESSION_2", "%3=x"),
+    ]
+
+
+def test_get_vmux_sessions(monkeypatch):
+    """Only vmux sessions are returned, each of them once."""
+    monkeypatch.setattr(
+        vmux.subprocess, "check_output", lambda cmd, **kwargs: b"$0\n$1\n"
+    )
+    StubPopen.output = (
+        b"VMUX_SESSION=global\nVMUX_GLOBAL_PANE=%9\n"
+        b"VMUX_SESSION_0=%1\nTERM=screen\n"
+        b"VMUX_SESSION_1=%1\nVMUX_SESSION_2=\n-VMUX_SESSION_3\n"
+    )
+    monkeypatch.setattr(vmux.subprocess, "Popen", StubPopen)
+    assert vmux.get_vmux_sessions() == ["global", "%1"]
+
+
+def test_get_vmux_sessions_without_server(monkeypatch):
+    """No sessions are returned if no tmux server is running."""
+
+    def check_output(cmd, **kwargs):
+        raise subprocess.CalledProcessError(1, cmd)
+
+    monkeypatch.setattr(vmux.subprocess, "check_output", check_output)
+    assert vmux.get_vmux_sessions() == []
+
+
+def test_send(session_dirs):
+    """Each editor receives the command in its own way."""
+    cmd, stdin = Neovim(None).send("%1", 'echo "<CR>"')
+    assert cmd[1:] == [
+        "--server",
+        str(session_dirs["nvim"] / "%1"),
+        "--remote-send",
+        '<C-\\><C-N>:echo "<lt>CR>"<CR>',
+    ]
+    assert stdin is None
+
+    cmd, stdin = Nvr(None).send("%1", 'echo "<CR>"')
+    assert cmd[1:] == [
+        "--servername",
+        str(session_dirs["nvr"] / "%1"),
+        "-c",
+        'echo "<CR>"',
+    ]
+    assert stdin is None
+
+    cmd, stdin = Kak(None).send("%1", "echo <CR>")
+    assert cmd[1:] == ["-p", "%1"]
+    assert stdin == "echo <CR>"
+
+
+def test_broadcast(session_dirs, monkeypatch, capsys):
+    """Every live session is reported and failures set the exit code."""
+    sessions = ["%1", "%2", "%3", "%4", "%5", "%6"]
+    monkeypatch.setattr(vmux, "get_vmux_sessions", lambda: sessions)
+    for name, session in (
+        ("nvim", "%1"),
+        ("nvim", "%2"),
+        ("nvr", "%3"),
+        ("kak", "%4"),
+        ("nvim", "%5"),
+    ):
+        session_dirs[name].mkdir(exist_ok=True)
+        (session_dirs[name] / session).touch()
+
+    def run(cmd, input=None, timeout=None, **kwargs):
+        if "%2" in " ".join(cmd):
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if "%3" in " ".join(cmd):
+            raise OSError("No such file or directory")
+        if "%4" in cmd:
+            assert input == b"checktime"
+            return subprocess.CompletedProcess(cmd, 3, stderr=b"boom\n")
+        return subprocess.CompletedProcess(cmd, 0, stderr=b"")
+
+    monkeypatch.setattr(vmux.subprocess, "run", run)
+    monkeypatch.setenv("VMUX_BROADCAST_TIMEOUT", "0.5")
+
+    assert broadcast("checktime") == 1
+    assert capsys.readouterr().out.splitlines() == [
+        "%1 (nvim): ok",
+        "%2 (nvim): timeout after 0.5s",
+        "%3 (nvr): No such file or directory",
+        "%4 (kak): failed with exit code 3: boom",
+        "%5 (nvim): ok",
+    ]
+
+
+def test_broadcast_unused_session_dirs(session_dirs, monkeypatch, capsys):
+    """Unused session directories aren't created."""
+    monkeypatch.setattr(vmux, "get_vmux_sessions", lambda: ["%1"])
+    session_dirs["nvim"].mkdir()
+    (session_dirs["nvim"] / "%1").touch()
+    monkeypatch.setattr(
+        vmux.subprocess,
+        "run",
+        lambda cmd, **kwargs: subprocess.CompletedProcess(cmd, 0, stderr=b""),
+    )
+
+    assert broadcast("checktime") == 0
+    assert capsys.readouterr().out.splitlines() == ["%1 (nvim): ok"]
+    assert not session_dirs["nvr"].exists()
+    assert not session_dirs["kak"].exists()
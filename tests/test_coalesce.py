@@ -0,0 +1,134 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import pytest
+
+from vmux.__main__ import coalesce_open
+
+ctx = multiprocessing.get_context("fork")
+
+
+class StubVmux(object):
+    session = "%1"
+    pane_id = "%1"
+    shall_select_pane = False
+
+    def __init__(self, coalesce_window):
+        self.coalesce_window = coalesce_window
+
+    def select_pane(self, pane_id=""):
+        pass
+
+
+class StubEditor(object):
+    cli = False
+
+    def __init__(self, tmp_path, res=0):
+        self.coalesce_dir = str(tmp_path / "%1.coalesce")
+        self.log = str(tmp_path / "open.log")
+        self.res = res
+
+    def open(self, args):
+        with open(self.log, "a") as f:
+            f.write(json.dumps(args) + "\n")
+        return self.res
+
+    @property
+    def calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+
+def caller(v, editor, args):
+    sys.exit(coalesce_open(v, editor, args))
+
+
+def wait_for_requests(spool, count):
+    for _ in range(500):
+        if os.path.isdir(spool):
+            if len([f for f in os.listdir(spool) if f.endswith(".req")]) == count:
+                return
+        time.sleep(0.01)
+    raise AssertionError("requests didn't show up in %s" % spool)
+
+
+@pytest.mark.parametrize("res", [0, 3])
+def test_coalesce_batches_requests(tmp_path, res):
+    """Concurrent requests result in a single, deduplicated open call."""
+    v = StubVmux(1.0)
+    editor = StubEditor(tmp_path, res=res)
+    requests = [["/f/a", "/f/b"], ["/f/b", "/f/c"], ["/f/a"]]
+    processes = []
+    for i, args in enumerate(requests):
+        p = ctx.Process(target=caller, args=(v, editor, args))
+        p.start()
+        processes.append(p)
+        wait_for_requests(editor.coalesce_dir, i + 1)
+    for p in processes:
+        p.join(10)
+
+    assert [p.exitcode for p in processes] == [res] * len(requests)
+    assert editor.calls == [["/f/a", "/f/b", "/f/c"]]
+    assert os.listdir(editor.coalesce_dir) == ["lock"]
+
+
+def test_coalesce_lost_request(tmp_path):
+    """A request claimed by a leader that died fails instead of hanging."""
+    v = StubVmux(0)
+    editor = StubEditor(tmp_path)
+    os.makedirs(editor.coalesce_dir)
+    with open(os.path.join(editor.coalesce_dir, "lock"), "w") as lock:
+        # act as a leader that claims the request and dies
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        p = ctx.Process(target=caller, args=(v, editor, ["/f/a"]))
+        p.start()
+        wait_for_requests(editor.coalesce_dir, 1)
+        for f in os.listdir(editor.coalesce_dir):
+            if f.endswith(".req"):
+                os.remove(os.path.join(editor.coalesce_dir, f))
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    p.join(10)
+
+    assert p.exitcode == 1
+    assert editor.calls == []
+
+
+def test_coalesce_skips_stale_requests(tmp_path):
+    """Requests of processes that no longer exist aren't opened."""
+    v = StubVmux(0)
+    editor = StubEditor(tmp_path)
+    p = ctx.Process(target=time.sleep, args=(0,))
+    p.start()
+    p.join()
+    os.makedirs(editor.coalesce_dir)
+    for name, content in (
+        ("%d-1.req" % p.pid, '["/f/stale"]'),
+        ("%d-1.status" % p.pid, "0"),
+    ):
+        with open(os.path.join(editor.coalesce_dir, name), "w") as f:
+            f.write(content)
+
+    assert coalesce_open(v, editor, ["/f/a"]) == 0
+    assert editor.calls == [["/f/a"]]
+    assert os.listdir(editor.coalesce_dir) == ["lock"]
+
+
+def test_coalesce_orders_by_arrival(tmp_path):
+    """Requests are opened in the order of the time stored in their id."""
+    v = StubVmux(0)
+    editor = StubEditor(tmp_path)
+    os.makedirs(editor.coalesce_dir)
+    # the ids of the requests sort the other way round as strings
+    for ns, path in ((10, "/f/b"), (9, "/f/a")):
+        name = "%d-%d.req" % (os.getpid(), ns)
+        with open(os.path.join(editor.coalesce_dir, name), "w") as f:
+            json.dump([path], f)
+
+    assert coalesce_open(v, editor, ["/f/c"]) == 0
+    assert editor.calls == [["/f/a", "/f/b", "/f/c"]]
@@ -24,14 +24,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import fcntl
+import json
 import os
 import shutil
 import subprocess
 import sys
+import time
 
 TMUX_ENVIRON_CACHE = {}
 TMUX_ENVIRON_CACHE_GLOBAL = {}
 DEBUG = os.environ.get("VMUX_DEBUG")
+BROADCAST_TIMEOUT = 1.0
+COALESCE_POLL_INTERVAL = 0.01
 
 
 def clear_tmux_environ_cache():
@@ -40,6 +46,16 @@ def clear_tmux_environ_cache():
     TMUX_ENVIRON_CACHE_GLOBAL = {}
 
 
+def parse_tmux_environ(output: bytes) -> list[tuple[str, str]]:
+    """Return the variables in the output of tmux show-environment."""
+    env = output.decode("utf-8").split(os.linesep)
+    return [
+        (kv[0], kv[1])
+        for kv in [v.split("=", 1) for v in env if "=" in v]
+        if len(kv) == 2
+    ]
+
+
 def get_tmux_environ(key: str, is_global: bool = False) -> str | None:
     global TMUX_ENVIRON_CACHE, TMUX_ENVIRON_CACHE_GLOBAL
     if is_global and TMUX_ENVIRON_CACHE_GLOBAL:
@@ -51,13 +67,11 @@ def get_tmux_environ(key: str, is_global: bool = False) -> str | None:
     if is_global:
         cmd.append("-g")
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    env = p.communicate()[0].decode("utf-8").split(os.linesep)
-    for kv in [v.split("=", 1) for v in env if "=" in v]:
-        if len(kv) == 2:
-            if is_global:
-                TMUX_ENVIRON_CACHE_GLOBAL[kv[0]] = kv[1]
-            else:
-                TMUX_ENVIRON_CACHE[kv[0]] = kv[1]
+    for k, v in parse_tmux_environ(p.communicate()[0]):
+        if is_global:
+            TMUX_ENVIRON_CACHE_GLOBAL[k] = v
+        else:
+            TMUX_ENVIRON_CACHE[k] = v
     return get_tmux_environ(key, is_global=is_global)
 
 
@@ -71,6 +85,37 @@ def args_to_absolute_paths(args: list[str]):
     return abs_args
 
 
+def get_vmux_sessions() -> list[str]:
+    """Return the names of all vmux sessions known to the tmux server."""
+    try:
+        session_ids = (
+            subprocess.check_output(
+                ["tmux", "list-sessions", "-F", "#{session_id}"],
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .split()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        # no tmux server is running
+        return []
+
+    # query the global and all session environments with a single tmux call
+    cmd = ["tmux", "show-environment", "-g"]
+    for session_id in session_ids:
+        cmd.extend((";", "show-environment", "-t", session_id))
+    if DEBUG:
+        print("Executing command:", " ".join(cmd), file=sys.stderr)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    sessions = []
+    for k, v in parse_tmux_environ(p.communicate()[0]):
+        if k != "VMUX_SESSION" and not k.startswith("VMUX_SESSION_"):
+            continue
+        if v and v not in sessions:
+            sessions.append(v)
+    return sessions
+
+
 class Vmux(object):
     _global: bool | None = None
     _id: str = ""
@@ -79,6 +124,7 @@ class Vmux(object):
     _session_exists: str | None = None
     _global_session: str | None = None
     _shall_select_pane: bool | None = None
+    _coalesce_window: float | None = None
 
     def __init__(self):
         super().__init__()
@@ -93,6 +139,20 @@ class Vmux(object):
             self._shall_select_pane = not bool(os.environ.get("VMUX_NOT_SELECT_PANE"))
         return self._shall_select_pane
 
+    @property
+    def coalesce_window(self) -> float:
+        # time window in seconds in which open requests are batched, 0 turns
+        # coalescing off
+        if self._coalesce_window is None:
+            self._coalesce_window = 0.0
+            try:
+                self._coalesce_window = max(
+                    float(os.environ.get("VMUX_COALESCE", 0)) / 1000, 0.0
+                )
+            except ValueError:
+                print("Invalid value for VMUX_COALESCE", file=sys.stderr)
+        return self._coalesce_window
+
     @property
     def id(self) -> str:
         if not self._id:
@@ -204,7 +264,211 @@ class Vmux(object):
                 break
 
 
+def broadcast(command: str) -> int:
+    """Send command to all live editor sessions concurrently.
+
+    Every session is given VMUX_BROADCAST_TIMEOUT seconds to accept the
+    command.  One result line is printed per session; the return value is 0
+    if all sessions accepted the command, 1 otherwise.
+    """
+    try:
+        timeout = float(os.environ.get("VMUX_BROADCAST_TIMEOUT", BROADCAST_TIMEOUT))
+    except ValueError:
+        print("Invalid value for VMUX_BROADCAST_TIMEOUT", file=sys.stderr)
+        return 2
+    editors = [Nvr(None), Neovim(None), Kak(None)]
+    targets = []
+    for session in get_vmux_sessions():
+        for e in editors:
+            # don't create session directories of editors that were never used
+            if os.path.exists(os.path.join(e.session_dir_path, session)):
+                targets.append((e, session))
+                break
+
+    def send(editor, session) -> str:
+        cmd, stdin = editor.send(session, command)
+        if DEBUG:
+            print("Executing command:", " ".join(cmd), file=sys.stderr)
+        try:
+            p = subprocess.run(
+                cmd,
+                input=stdin.encode("utf-8") if stdin is not None else None,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return "timeout after %ss" % timeout
+        except OSError as e:
+            return str(e)
+        if p.returncode != 0:
+            err = p.stderr.decode("utf-8", "replace").strip()
+            return "failed with exit code %d%s" % (
+                p.returncode,
+                ": %s" % err if err else "",
+            )
+        return ""
+
+    res = 0
+    if not targets:
+        print("No live editor sessions found", file=sys.stderr)
+        return res
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = [pool.submit(send, e, session) for e, session in targets]
+        for (e, session), future in zip(targets, futures):
+            error = future.result()
+            if error:
+                res = 1
+            print("%s (%s): %s" % (session, e, error if error else "ok"))
+    return res
+
+
+def pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to another user
+        pass
+    return True
+
+
+def coalesce_open(v: Vmux, editor, args: list[str]) -> int:
+    """Open args in editor batched with other requests for the same session.
+
+    Every request is queued in a spool directory next to the session.  The
+    first caller becomes the leader: it waits for v.coalesce_window seconds,
+    opens all queued files with a single editor call and a single pane
+    selection and hands the exit status back to every queued caller.
+    """
+    spool = editor.coalesce_dir
+    os.makedirs(spool, exist_ok=True)
+    request_id = "%d-%d" % (os.getpid(), time.monotonic_ns())
+    request = os.path.join(spool, request_id + ".req")
+    status = os.path.join(spool, request_id + ".status")
+
+    def read_status() -> int:
+        with open(status) as f:
+            res = int(f.read())
+        os.remove(status)
+        return res
+
+    try:
+        # paths are relative to the caller's working directory, so resolve
+        # them before handing them to the leader
+        with open(request + ".tmp", "w") as f:
+            json.dump(args_to_absolute_paths(args), f)
+        os.rename(request + ".tmp", request)
+
+        with open(os.path.join(spool, "lock"), "w") as lock:
+            while True:
+                if os.path.exists(status):
+                    return read_status()
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(COALESCE_POLL_INTERVAL)
+
+            # the previous leader might have finished while acquiring the lock
+            if os.path.exists(status):
+                return read_status()
+            if not os.path.exists(request):
+                # the request was claimed by a leader that didn't finish
+                print("Request was lost by another vmux process", file=sys.stderr)
+                return 1
+
+            if DEBUG:
+                print(
+                    "Coalescing open requests for %ss" % v.coalesce_window,
+                    file=sys.stderr,
+                )
+            time.sleep(v.coalesce_window)
+            queue = []
+            for entry in os.scandir(spool):
+                if not entry.name.split("-", 1)[0].isdigit():
+                    # not a request of a vmux process, e.g. the lock file
+                    continue
+                if not entry.name.endswith(".req"):
+                    # remove leftovers of callers that were killed
+                    if not pid_exists(int(entry.name.split("-", 1)[0])):
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                # order requests by the arrival time stored in their id, file
+                # modification times are too coarse for rapid requests
+                queue.append((int(entry.name.split("-")[1].split(".")[0]), entry.name))
+            requests = []
+            for _, name in sorted(queue):
+                path = os.path.join(spool, name)
+                try:
+                    with open(path) as f:
+                        request_args = json.load(f)
+                    os.remove(path)
+                except FileNotFoundError:
+                    # the caller gave up on its request
+                    continue
+                if not pid_exists(int(name.split("-", 1)[0])):
+                    # left behind by a caller that was killed
+                    continue
+                requests.append((name[: -len(".req")], request_args))
+            batch = []
+            for _, request_args in requests:
+                batch.extend(a for a in request_args if a not in batch)
+
+            res = 1
+            try:
+                if v.shall_select_pane and editor.cli:
+                    if DEBUG:
+                        print("Selecting pane with id %s" % v.pane_id, file=sys.stderr)
+                    v.select_pane()
+                if DEBUG:
+                    print(
+                        "Opening %d files for %d requests"
+                        % (len(batch), len(requests)),
+                        file=sys.stderr,
+                    )
+                res = editor.open(batch)
+                if v.shall_select_pane and editor.cli:
+                    pane_id = os.environ.get("TMUX_PANE")
+                    if DEBUG:
+                        print(
+                            "Reverting pane selection to id %s" % v.pane_id,
+                            file=sys.stderr,
+                        )
+                    v.select_pane(pane_id)
+            except Exception:
+                import traceback
+
+                traceback.print_exc()
+            finally:
+                for other_id, _ in requests:
+                    if other_id == request_id:
+                        continue
+                    other_status = os.path.join(spool, other_id + ".status")
+                    with open(other_status + ".tmp", "w") as f:
+                        f.write(str(res))
+                    os.rename(other_status + ".tmp", other_status)
+            return res
+    finally:
+        # don't leave an unclaimed request behind for an unrelated caller
+        for path in (request + ".tmp", request, status):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
 def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "--broadcast":
+        if len(sys.argv) < 3:
+            print("Usage: vmux --broadcast COMMAND", file=sys.stderr)
+            return 2
+        return broadcast(" ".join(sys.argv[2:]))
+
     v = None
     try:
         v = Vmux()
@@ -272,6 +536,13 @@ def main():
         new_session = False
         # open files in existing session
         if len(sys.argv) >= 2 and editor_with_session:
+            if (
+                v.coalesce_window
+                and editor_with_session.coalesce
+                and not any(a.startswith(("-", "+")) for a in sys.argv[1:])
+            ):
+                # only plain file arguments can be merged with other requests
+                return coalesce_open(v, editor_with_session, sys.argv[1:])
             if v.shall_select_pane and editor_with_session.cli:
                 if DEBUG:
                     print("Selecting pane with id %s" % v.pane_id, file=sys.stderr)
@@ -317,6 +588,7 @@ class Editor(object):
     def __init__(self, vmux):
         self.cmd: str
         self.cli: bool
+        self.coalesce: bool
         self._vmux: Vmux = vmux
         super().__init__()
 
@@ -354,6 +626,7 @@ class Editor(object):
 class Vim(Editor):
     cmd = "vim"
     cli = True
+    coalesce = False
 
     def __init__(self, vmux):
         super().__init__(vmux)
@@ -424,13 +697,14 @@ class Gvim(Vim):
 class Neovim(Editor):
     cmd = "nvim"
     cli = True
+    coalesce = True
     _session_dir: str = ""
 
     def __init__(self, vmux):
         super().__init__(vmux)
 
     @property
-    def session_dir(self) -> str:
+    def session_dir_path(self) -> str:
         if not self._session_dir:
             default = os.path.join(
                 os.environ.get("HOME", "/tmp"), ".cache", "tmp", "nvim_sessions"
@@ -438,10 +712,14 @@ class Neovim(Editor):
             self._session_dir = os.path.expandvars(
                 os.path.expanduser(os.environ.get("VMUX_NVIM_SESSION_DIR", default))
             )
-        if self._session_dir and not os.path.exists(self._session_dir):
-            os.makedirs(self._session_dir)
         return self._session_dir
 
+    @property
+    def session_dir(self) -> str:
+        if self.session_dir_path and not os.path.exists(self.session_dir_path):
+            os.makedirs(self.session_dir_path)
+        return self.session_dir_path
+
     @property
     def session_exists(self) -> bool:
         if not self._vmux.session_exists:
@@ -452,9 +730,14 @@ class Neovim(Editor):
     def session_address(self) -> str:
         return os.path.join(self.session_dir, self._vmux.session)
 
+    @property
+    def coalesce_dir(self) -> str:
+        return self.session_address + ".coalesce"
+
     def destroy_session(self) -> None:
         if os.path.exists(self.session_address):
             os.remove(self.session_address)
+        shutil.rmtree(self.coalesce_dir, ignore_errors=True)
 
     def open(self, args: list[str]):
         cmd = [
@@ -467,6 +750,17 @@ class Neovim(Editor):
             print("Executing command:", " ".join(cmd), file=sys.stderr)
         return subprocess.call(cmd)
 
+    def send(self, session: str, command: str) -> tuple[list[str], None]:
+        # leave any pending mode before entering the command and escape < so
+        # that the command isn't interpreted as key notation
+        return [
+            self.realdeditor,
+            "--server",
+            os.path.join(self.session_dir_path, session),
+            "--remote-send",
+            "<C-\\><C-N>:%s<CR>" % command.replace("<", "<lt>"),
+        ], None
+
     def new(self, args: list[str], new_session: bool = True):
         if not args:
             new_session = True
@@ -493,12 +787,13 @@ class Neovim(Editor):
 
 class Nvr(Neovim):
     cmd = "nvr"
+    coalesce = False
 
     def __init__(self, vmux):
         super().__init__(vmux)
 
     @property
-    def session_dir(self) -> str:
+    def session_dir_path(self) -> str:
         if not self._session_dir:
             default = os.path.join(
                 os.environ.get("HOME", "/tmp"), ".cache", "tmp", "nvr_sessions"
@@ -506,8 +801,6 @@ class Nvr(Neovim):
             self._session_dir = os.path.expandvars(
                 os.path.expanduser(os.environ.get("VMUX_NVR_SESSION_DIR", default))
             )
-        if self._session_dir and not os.path.exists(self._session_dir):
-            os.makedirs(self._session_dir)
         return self._session_dir
 
     def new(self, args: list[str], new_session: bool = True):
@@ -542,6 +835,15 @@ class Nvr(Neovim):
             print("Executing command:", " ".join(cmd), file=sys.stderr)
         os.execvp(cmd[0], cmd)
 
+    def send(self, session: str, command: str) -> tuple[list[str], None]:
+        return [
+            self.realdeditor,
+            "--servername",
+            os.path.join(self.session_dir_path, session),
+            "-c",
+            command,
+        ], None
+
 
 class NeovimQt(Neovim):
     cmd = "nvim-qt"
@@ -562,6 +864,9 @@ class Gnvim(Neovim):
 class Kak(Editor):
     cmd = "kak"
     cli = True
+    # kak -c runs an interactive client, so open doesn't return until the
+    # user quits it
+    coalesce = False
     _session_dir: str = ""
 
     def __init__(self, vmux):
@@ -588,8 +893,11 @@ class Kak(Editor):
             print("Executing command:", " ".join(cmd), file=sys.stderr)
         os.execvp(self.realdeditor, cmd + args_to_absolute_paths(args))
 
+    def send(self, session: str, command: str) -> tuple[list[str], str]:
+        return [self.realdeditor, "-p", session], command
+
     @property
-    def session_dir(self):
+    def session_dir_path(self):
         if not self._session_dir:
             default = os.path.join(
                 os.environ.get("HOME", "/tmp"), ".cache", "tmp", "kakoune_sessions"
@@ -598,10 +906,14 @@ class Kak(Editor):
             self._session_dir = os.path.expandvars(
                 os.path.expanduser(os.environ.get("VMUX_KAK_SESSION_DIR", default))
             )
-        if self._session_dir and not os.path.exists(self._session_dir):
-            os.makedirs(self._session_dir)
         return self._session_dir
 
+    @property
+    def session_dir(self):
+        if self.session_dir_path and not os.path.exists(self.session_dir_path):
+            os.makedirs(self.session_dir_path)
+        return self.session_dir_path
+
     @property
     def session_exists(self):
         if not self._vmux.session_exists: